@@ -1,5 +1,7 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from datetime import datetime
 from uuid import uuid4
+from .http_client import MAX_ATTEMPTS, HttpClient, RequestBudget, backoff
 from .utils import log
 import jwt
 import requests
@@ -10,59 +12,92 @@ import time
 # How many seconds should pass between each call to the GitHub API.
 GITHUB_API_POLL_INTERVAL = 15
 
+# How many seconds before its expiry an installation token should be refreshed.
+TOKEN_REFRESH_MARGIN = 5 * 60
+
 
 class GitHub:
     def __init__(self, cli):
         self.org = cli.github_org
 
-        self._http = requests.Session()
-        self._http.headers["User-Agent"] = (
-            "rust-lang/gha-self-hosted (infra@rust-lang.org)"
-        )
-
-        log(f"generating a JWT to authenticate as app {cli.github_client_id}")
-        bearer = jwt.encode(
-            {
-                "iat": int(time.time() - 60),
-                "exp": int(time.time() + 60 * 5),
-                "iss": cli.github_client_id,
-            },
-            open(cli.github_private_key, "rb").read(),
-            algorithm="RS256",
-        )
-
-        log(f"retrieving app installation id for {self.org}")
-        resp = self._handle_error(
-            self._http.get(
-                f"https://api.github.com/orgs/{self.org}/installation",
-                headers={"Authorization": f"Bearer {bearer}"},
-            )
-        )
-        installation = resp.json()["id"]
-
-        log(f"retrieving token for installation {installation}")
-        resp = self._handle_error(
-            self._http.post(
-                f"https://api.github.com/app/installations/{installation}/access_tokens",
-                headers={"Authorization": f"Bearer {bearer}"},
+        self._client_id = cli.github_client_id
+        self._private_key = open(cli.github_private_key, "rb").read()
+
+        budget = None
+        if cli.github_api_budget is not None:
+            budget = RequestBudget(cli.github_api_budget_file, cli.github_api_budget)
+        self._http = HttpClient(budget)
+
+        # Installation tokens expire after an hour, which is shorter than the lifetime of an
+        # executor running in loop mode. The token is thus refreshed on demand before each request.
+        self._installation = None
+        self._token_expires_at = 0.0
+        self._token_lock = threading.Lock()
+        self._ensure_token()
+
+    def _ensure_token(self):
+        with self._token_lock:
+            if time.time() < self._token_expires_at - TOKEN_REFRESH_MARGIN:
+                return
+
+            log(f"generating a JWT to authenticate as app {self._client_id}")
+            bearer = jwt.encode(
+                {
+                    "iat": int(time.time() - 60),
+                    "exp": int(time.time() + 60 * 5),
+                    "iss": self._client_id,
+                },
+                self._private_key,
+                algorithm="RS256",
             )
-        )
-
-        self._http.headers["Authorization"] = f"token {resp.json()['token']}"
 
+            if self._installation is None:
+                log(f"retrieving app installation id for {self.org}")
+                resp = self._handle_error(
+                    self._http.get(
+                        f"https://api.github.com/orgs/{self.org}/installation",
+                        headers={"Authorization": f"Bearer {bearer}"},
+                    )
+                )
+                self._installation = resp.json()["id"]
+
+            log(f"retrieving token for installation {self._installation}")
+            resp = self._handle_error(
+                self._http.post(
+                    f"https://api.github.com/app/installations/{self._installation}/access_tokens",
+                    headers={"Authorization": f"Bearer {bearer}"},
+                    # Generating an extra token is harmless.
+                    idempotent=True,
+                )
+            ).json()
+
+            self._http.session.headers["Authorization"] = f"token {resp['token']}"
+            self._token_expires_at = datetime.fromisoformat(
+                resp["expires_at"]
+            ).timestamp()
+
+    # Errors are raised rather than exiting, so that the threads managing VMs can clean up after
+    # themselves, and the autoscaler can survive a GitHub outage.
     def _handle_error(self, response: requests.Response) -> requests.Response:
         if response.status_code >= 400:
-            print(
-                f"error: github responded with status {response.status_code} to the request"
+            try:
+                message = response.json()["message"]
+            except (ValueError, KeyError):
+                message = response.text
+            raise GitHubError(
+                f"github responded with status {response.status_code} to {response.url}: "
+                f"{message}"
             )
-            print(f"url: {response.url}")
-            print(f"message: {response.json()['message']}")
-            exit(1)
         return response
 
     def create_runner(self, cli, instance):
-        resp = self._handle_error(
-            self._http.post(
+        self._ensure_token()
+        # The request is not retried by the HTTP client on server errors, as GitHub might have
+        # registered the runner anyway, and retrying with the same name would then fail. Retry it
+        # here with a new name instead: a runner that was registered anyway never connects, and is
+        # eventually removed by GitHub.
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            r = self._http.post(
                 f"https://api.github.com/orgs/{self.org}/actions/runners/generate-jitconfig",
                 json={
                     "name": f"{instance['label']}-{uuid4()}",
@@ -70,41 +105,114 @@ class GitHub:
                     "labels": [instance["label"]],
                 },
             )
-        ).json()
+            if r.status_code < 500 or attempt == MAX_ATTEMPTS:
+                break
+            delay = backoff(attempt)
+            log(
+                f"failed to register the runner ({r.status_code}), retrying in {delay:.0f}s"
+            )
+            time.sleep(delay)
+
+        resp = self._handle_error(r).json()
         return RunnerInfo(id=resp["runner"]["id"], jitconfig=resp["encoded_jit_config"])
 
     def get_runner(self, id):
+        self._ensure_token()
         r = self._http.get(
-            f"https://api.github.com/orgs/{self.org}/actions/runners/{id}"
+            f"https://api.github.com/orgs/{self.org}/actions/runners/{id}",
+            conditional=True,
         )
+        # Ephemeral runners are removed by GitHub as soon as the job finishes, which can happen
+        # before the VM has finished powering off.
+        if r.status_code == 404:
+            return None
         return self._handle_error(r).json()
 
+    def get_queued_jobs(self, repo):
+        self._ensure_token()
+        jobs = []
+        # Runs that are already in progress can still have queued jobs (for example when a matrix
+        # has more jobs than available runners), so both kinds of runs have to be checked.
+        for status in ("queued", "in_progress"):
+            for run in self._get_paginated(
+                f"https://api.github.com/repos/{self.org}/{repo}/actions/runs",
+                "workflow_runs",
+                {"status": status, "per_page": 100},
+            ):
+                for job in self._get_paginated(
+                    f"https://api.github.com/repos/{self.org}/{repo}/actions/runs/{run['id']}/jobs",
+                    "jobs",
+                    {"filter": "latest", "per_page": 100},
+                ):
+                    if job["status"] == "queued":
+                        jobs.append(job)
+        return jobs
+
+    # Iterate over all the items of a paginated endpoint, following the `next` links. The URLs of
+    # the following pages already include the query string.
+    def _get_paginated(self, url, key, params):
+        while url is not None:
+            resp = self._handle_error(
+                self._http.get(url, params=params, conditional=True)
+            )
+            yield from resp.json()[key]
+            url = resp.links.get("next", {}).get("url")
+            params = None
+
+    def delete_runner(self, id):
+        self._ensure_token()
+        r = self._http.delete(
+            f"https://api.github.com/orgs/{self.org}/actions/runners/{id}"
+        )
+        if r.status_code != 404:
+            self._handle_error(r)
+
+
+class GitHubError(Exception):
+    pass
+
 
 class GitHubRunnerStatusWatcher(threading.Thread):
-    def __init__(self, gh, runner_id, then):
+    def __init__(self, gh, runner_id, then, on_status=None):
         super().__init__(name="github-runner-status-watcher", daemon=True)
 
         self._gh = gh
         self._runner_id = runner_id
         self._then = then
+        self._on_status = on_status
+        self._stopped = threading.Event()
 
     def run(self):
         log("started polling GitHub to detect when the runner started working")
         last_status = "offline"
         build_started = False
-        while True:
-            runner = self._gh.get_runner(self._runner_id)
+        while not self._stopped.is_set():
+            try:
+                runner = self._gh.get_runner(self._runner_id)
+            except (requests.RequestException, GitHubError) as e:
+                log(f"warning: failed to retrieve the runner status: {e}")
+                self._stopped.wait(GITHUB_API_POLL_INTERVAL)
+                continue
+            if runner is None:
+                log("the runner was removed from GitHub")
+                return
             if runner["status"] != last_status:
                 log(f"runner status changed to {runner['status']}")
                 last_status = runner["status"]
+            if self._on_status is not None:
+                self._on_status(runner)
             if runner["busy"] and not build_started:
                 log("the runner started processing a build!")
                 self._then()
                 build_started = True
-            time.sleep(GITHUB_API_POLL_INTERVAL)
+            self._stopped.wait(GITHUB_API_POLL_INTERVAL)
+
+    def stop(self):
+        self._stopped.set()
 
 
 @dataclass
 class RunnerInfo:
     id: int
     jitconfig: str
+    registered_at: float = field(default_factory=time.time)
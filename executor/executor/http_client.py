@@ -0,0 +1,256 @@
+# Shared HTTP layer used to talk with the GitHub API and the images server.
+#
+# Transient failures (connection errors, 5xx responses and rate limits) are retried with jittered
+# exponential backoff, honoring the `Retry-After` and `X-RateLimit-*` headers sent by GitHub. This
+# prevents a single hiccup from killing a VM that is starting.
+#
+# Endpoints that are polled can be requested with `conditional=True`: the ETag (or Last-Modified
+# date) of the previous response is then sent back, and when the server replies with 304 Not
+# Modified the previous response is returned instead. GitHub doesn't count 304 responses against
+# the rate limit, so polling an unchanged resource is free.
+#
+# Finally, requests to GitHub can be paced with a `RequestBudget`, a token bucket stored in a file
+# shared by all the executors running on the host. This divides the hourly API budget allocated to
+# the host across all of its runners, rather than letting each of them consume it independently.
+
+from .utils import log
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional
+import fcntl
+import json
+import random
+import requests
+import threading
+import time
+
+
+USER_AGENT = "rust-lang/gha-self-hosted (infra@rust-lang.org)"
+
+# How many times a request is attempted before giving up.
+MAX_ATTEMPTS = 6
+
+# Bounds (in seconds) of the exponential backoff between attempts.
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+# Minimum number of seconds to wait after hitting a secondary rate limit that didn't include a
+# Retry-After header, as recommended by GitHub.
+SECONDARY_RATE_LIMIT_DELAY = 60
+
+# How many responses to keep around for conditional requests.
+CONDITIONAL_CACHE_SIZE = 1000
+
+# Methods that can be safely retried after the server might have processed the request. Other
+# methods are only retried when the request surely wasn't processed (for example when it was rate
+# limited, or the connection couldn't be established).
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+
+
+class HttpClient:
+    def __init__(self, budget: Optional["RequestBudget"] = None):
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+
+        self._budget = budget
+        self._cache: Dict[str, requests.Response] = {}
+        self._cache_lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    # Pass `idempotent=True` for requests using a non-idempotent method that are still safe to
+    # repeat, so that they are also retried on server errors.
+    def request(
+        self, method, url, conditional=False, idempotent=None, **kwargs
+    ) -> requests.Response:
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+
+        cache_key = None
+        cached = None
+        if conditional:
+            cache_key = requests.Request(method, url, params=kwargs.get("params"))
+            cache_key = cache_key.prepare().url
+            with self._cache_lock:
+                cached = self._cache.get(cache_key)
+            if cached is not None:
+                headers = dict(kwargs.pop("headers", None) or {})
+                if "ETag" in cached.headers:
+                    headers["If-None-Match"] = cached.headers["ETag"]
+                if "Last-Modified" in cached.headers:
+                    headers["If-Modified-Since"] = cached.headers["Last-Modified"]
+                kwargs["headers"] = headers
+
+        attempt = 0
+        while True:
+            attempt += 1
+            if self._budget is not None:
+                self._budget.acquire()
+
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= MAX_ATTEMPTS or not (idempotent or _not_sent(e)):
+                    raise
+                delay = backoff(attempt)
+                log(f"warning: {method} {url} failed ({e}), retrying in {delay:.0f}s")
+                time.sleep(delay)
+                continue
+
+            if (
+                self._budget is not None
+                and resp.headers.get("X-RateLimit-Remaining") == "0"
+            ):
+                self._budget.pause_until(int(resp.headers["X-RateLimit-Reset"]))
+            # GitHub doesn't count 304 responses against the rate limit, so neither does the
+            # budget, as otherwise polling would be throttled even when it's free.
+            if self._budget is not None and resp.status_code == 304:
+                self._budget.refund()
+
+            delay = _retry_delay(resp, attempt, idempotent)
+            # Secondary rate limits apply to the whole installation, so the other executors sharing
+            # the budget have to wait too.
+            if (
+                self._budget is not None
+                and delay is not None
+                and _is_secondary_rate_limit(resp)
+            ):
+                self._budget.pause_until(time.time() + delay)
+            if delay is None or attempt >= MAX_ATTEMPTS:
+                break
+            log(
+                f"warning: {method} {url} failed with status {resp.status_code}, "
+                f"retrying in {delay:.0f}s"
+            )
+            time.sleep(delay)
+
+        if cached is not None and resp.status_code == 304:
+            return cached
+        if cache_key is not None and resp.status_code == 200:
+            if "ETag" in resp.headers or "Last-Modified" in resp.headers:
+                with self._cache_lock:
+                    self._cache.pop(cache_key, None)
+                    self._cache[cache_key] = resp
+                    # Dicts preserve insertion order, so the first key is the oldest one.
+                    if len(self._cache) > CONDITIONAL_CACHE_SIZE:
+                        del self._cache[next(iter(self._cache))]
+
+        return resp
+
+
+# Return how many seconds to wait before retrying a request, or None if it shouldn't be retried.
+def _retry_delay(resp: requests.Response, attempt, idempotent):
+    retry_after = resp.headers.get("Retry-After")
+
+    if resp.status_code in (403, 429):
+        # Secondary rate limits include a Retry-After header.
+        if retry_after is not None and retry_after.isdigit():
+            return int(retry_after)
+        # Primary rate limits require waiting until the limit is reset.
+        if resp.headers.get("X-RateLimit-Remaining") == "0":
+            reset = int(resp.headers["X-RateLimit-Reset"])
+            return max(reset - time.time(), 0) + 1
+        # Secondary rate limits without a Retry-After header require waiting at least a minute.
+        if _is_secondary_rate_limit(resp):
+            return SECONDARY_RATE_LIMIT_DELAY + backoff(attempt)
+        if resp.status_code == 429:
+            return backoff(attempt)
+        # Other 403s are permission errors, which retrying will not fix.
+        return None
+
+    # The server might have processed the request before failing, so repeating a non-idempotent one
+    # could do the same thing twice.
+    if resp.status_code >= 500 and idempotent:
+        if retry_after is not None and retry_after.isdigit():
+            return int(retry_after)
+        return backoff(attempt)
+
+    return None
+
+
+# GitHub doesn't use a specific status code or header for secondary rate limits, and they can only
+# be told apart from permission errors by the message.
+def _is_secondary_rate_limit(resp: requests.Response):
+    try:
+        message = resp.json()["message"]
+    except (ValueError, KeyError, TypeError):
+        return False
+    return "secondary rate limit" in str(message).lower()
+
+
+# Whether the request surely didn't reach the server, as the connection couldn't be established.
+def _not_sent(error):
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    # urllib3 is only a dependency of requests, so it's accessed through it.
+    reason = getattr(error.args[0] if error.args else None, "reason", None)
+    return isinstance(reason, requests.packages.urllib3.exceptions.NewConnectionError)
+
+
+# Exponential backoff with "equal jitter", so that executors failing at the same time (for example
+# during a GitHub outage) don't all retry at the same time.
+def backoff(attempt):
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class RequestBudget:
+    def __init__(self, path: Path, requests_per_hour):
+        self._path = path
+        self._rate = requests_per_hour / 3600
+        # Allow bursts of up to a minute worth of requests, as starting a VM requires a few of
+        # them in quick succession.
+        self._burst = max(1, requests_per_hour / 60)
+
+    def acquire(self):
+        while True:
+            with self._locked_state() as state:
+                now = time.time()
+                wait = state["paused_until"] - now
+                if wait <= 0:
+                    tokens = state["tokens"] + (now - state["updated"]) * self._rate
+                    state["tokens"] = min(self._burst, tokens)
+                    state["updated"] = now
+                    if state["tokens"] >= 1:
+                        state["tokens"] -= 1
+                        return
+                    wait = (1 - state["tokens"]) / self._rate
+            time.sleep(wait)
+
+    # Give back the token used by a request that didn't count against the rate limit.
+    def refund(self):
+        with self._locked_state() as state:
+            state["tokens"] = min(self._burst, state["tokens"] + 1)
+
+    def pause_until(self, timestamp):
+        with self._locked_state() as state:
+            state["paused_until"] = max(state["paused_until"], timestamp)
+
+    # The state is stored in a file locked with flock(2), which works both across processes and
+    # across threads (as each call opens the file again).
+    @contextmanager
+    def _locked_state(self):
+        with open(self._path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                state = json.loads(f.read())
+            except ValueError:
+                state = {
+                    "tokens": self._burst,
+                    "updated": time.time(),
+                    "paused_until": 0,
+                }
+
+            yield state
+
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
@@ -18,7 +18,7 @@
 from .utils import log
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from tempfile import NamedTemporaryFile
-from threading import Thread
+from threading import Event, Thread
 import secrets
 
 
@@ -30,6 +30,7 @@ class CredentialServer:
     def __init__(self, name, value):
         token = secrets.token_urlsafe(64)
         already_requested = False
+        retrieved = Event()
 
         class ServerHandler(BaseHTTPRequestHandler):
             def do_GET(self):
@@ -53,6 +54,7 @@ class CredentialServer:
 
                     # Only allow the credential to be retrieved once.
                     already_requested = True
+                    retrieved.set()
 
             def _respond(self, code, message):
                 self.send_response(code)
@@ -66,9 +68,13 @@ class CredentialServer:
 
         server = HTTPServer(("127.0.0.1", 0), ServerHandler)
 
+        self._server = server
+        # Set once the VM retrieved the credential, to detect VMs stuck while booting.
+        self.retrieved = retrieved
         self._port = server.server_port
         self._name = name
         self._token = token
+        self._url_file = None
 
         thread = Thread(target=server.serve_forever, daemon=True)
         thread.start()
@@ -93,3 +99,9 @@ class CredentialServer:
         self._url_file.flush()
 
         qemu.smbios_11.append(f"path={self._url_file.name}")
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._url_file is not None:
+            self._url_file.close()
@@ -1,3 +1,4 @@
+from executor.http_client import HttpClient
 from executor.utils import log
 from pathlib import Path
 from zstandard import ZstdDecompressor
@@ -15,7 +16,7 @@ IMAGES_SERVER_POLL_INTERVAL = 5 * 60  # 5 minutes
 
 class ImagesRetriever:
     def __init__(self, cli):
-        self._http = requests.Session()
+        self._http = HttpClient()
         self._server = cli.images_server.rstrip("/")
 
         if cli.images_cache_dir is not None:
@@ -26,10 +27,18 @@ class ImagesRetriever:
             # avoids having separate code paths for "cached" and "not cached".
             self._storage_dir = Path(tempfile.mkdtemp())
 
-        self._latest_commit = self._get_text("latest")
+        # Images whose hash was already verified for the current commit. VMs only ever access the
+        # base images as read-only backing files, so there is no need to hash them again when the
+        # same process starts multiple VMs in loop mode.
+        self._verified: typing.Dict[str, Path] = {}
+
+        self._latest_commit = self._get_text("latest", conditional=True)
         self._purge_old_caches()
 
     def get_image(self, name):
+        if name in self._verified:
+            return self._verified[name]
+
         local_path = self._storage_dir / self._latest_commit / f"{name}.qcow2"
         local_path.parent.mkdir(exist_ok=True, parents=True)
 
@@ -57,10 +66,26 @@ class ImagesRetriever:
             print(f"remote hash: {remote_hash}")
             exit(1)
 
+        self._verified[name] = local_path
         return local_path
 
-    def _get_text(self, path):
-        resp = self._http.get(f"{self._server}/{path}")
+    # Switch to the latest commit on the images server, returning whether it changed. This purges
+    # the cache of the previous commit, so it must only be called when no VM is using its images.
+    def update(self):
+        new_commit = self._get_text("latest", conditional=True)
+        if new_commit == self._latest_commit:
+            return False
+
+        log(f"switching to images with commit {new_commit}")
+        self._latest_commit = new_commit
+        self._verified.clear()
+        self._purge_old_caches()
+        return True
+
+    # Polled endpoints should be requested with conditional=True, to avoid downloading them again
+    # when they didn't change.
+    def _get_text(self, path, conditional=False):
+        resp = self._http.get(f"{self._server}/{path}", conditional=conditional)
         resp.raise_for_status()
         return resp.text.strip()
 
@@ -83,7 +108,7 @@ class ImageUpdateWatcher(threading.Thread):
         while True:
             time.sleep(IMAGES_SERVER_POLL_INTERVAL)
             try:
-                new_commit = self._retriever._get_text("latest")
+                new_commit = self._retriever._get_text("latest", conditional=True)
             except requests.exceptions.RequestException as e:
                 print(f"warn: failed to check for image updates: {e}")
                 continue
@@ -0,0 +1,46 @@
+# Counters exported in the Prometheus text format.
+#
+# When a metrics file is configured, the counters are written to it after every change, so that
+# they can be collected by the node exporter's textfile collector. The file is loaded back when the
+# executor starts, as by default a new executor process is started for every job and the counters
+# would otherwise be reset all the time.
+
+from pathlib import Path
+from typing import Dict, Optional
+import os
+import threading
+
+
+_lock = threading.Lock()
+_path: Optional[Path] = None
+_counters: Dict[str, float] = {}
+
+
+def configure(path: Optional[Path]):
+    global _path
+    with _lock:
+        _path = path
+        if path is None or not path.exists():
+            return
+        for line in path.read_text().splitlines():
+            if not line or line.startswith("#"):
+                continue
+            series, value = line.rsplit(" ", 1)
+            _counters[series] = float(value)
+
+
+def increment(name, **labels):
+    series = name
+    if labels:
+        series += "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+    with _lock:
+        _counters[series] = _counters.get(series, 0) + 1
+        if _path is None:
+            return
+
+        # Write the new file next to the old one and then rename it, so that the collector never
+        # sees a partially written file.
+        tmp = _path.with_name(f".{_path.name}.{os.getpid()}")
+        tmp.write_text("".join(f"{s} {v:g}\n" for s, v in sorted(_counters.items())))
+        tmp.rename(_path)
@@ -1,6 +1,7 @@
 from executor.http_server import CredentialServer
-from .github import GitHubRunnerStatusWatcher
+from .github import GITHUB_API_POLL_INTERVAL, GitHubRunnerStatusWatcher
 from .qmp import QMPClient
+from . import metrics
 from .utils import log, Timer
 from dataclasses import dataclass, field
 from pathlib import Path
@@ -10,12 +11,29 @@ import pathlib
 import shutil
 import subprocess
 import tempfile
+import threading
+import time
 
 
 # How many seconds to wait after a graceful shutdown signal before killing the
 # virtual machine.
 GRACEFUL_SHUTDOWN_TIMEOUT = 60
 
+# Stages a booting VM has to go through, and how many seconds after starting QEMU each of them has
+# to be reached. A VM missing one of the deadlines is killed and started again from scratch, as
+# otherwise a VM stuck while booting would take up a slot until it's restarted manually.
+BOOT_DEADLINES = [
+    # QEMU created its QMP socket.
+    ("qemu-started", 30),
+    # The VM retrieved the jitconfig from the CredentialServer.
+    ("credential-fetched", 5 * 60),
+    # GitHub reports the runner as online.
+    ("runner-online", 10 * 60),
+]
+
+# How many times a VM is started before giving up when it fails to boot.
+MAX_BOOT_ATTEMPTS = 3
+
 # Architecture-specific QEMU flags and BIOS blob URL.
 QEMU_ARCH = {
     "x86_64": {
@@ -38,6 +56,7 @@ QEMU_ARCH = {
 class VM:
     def __init__(self, cli, instance, image, runner):
         self._cli = cli
+        self._instance = instance
         self._base = image
         self._vm_timeout = instance["timeout-seconds"]
         self._cpu = instance["cpu-cores"]
@@ -50,6 +69,23 @@ class VM:
         # would kill the CI build running in the VM.
         self._prevent_external_shutdowns = False
 
+        # The boot stage the VM failed to reach, if the last attempt at starting it failed.
+        self.boot_failure: Optional[str] = None
+        self._runner_online = False
+        # When GitHub last answered about the runner, and whether it was online at the time.
+        self._runner_last_report = None
+        self._shutdown_requested = False
+
+        # Whether the VM was stopped by the user with Ctrl+C, which should also stop the executor
+        # when it's running in loop mode.
+        self.interrupted = False
+
+        # Background threads tied to this VM, stopped once the VM exits. This matters in loop mode,
+        # where they would otherwise fire against a VM that is long gone.
+        self._timers: List[Timer] = []
+        self._status_watcher = None
+        self._boot_watchdog = None
+
         self._arch = instance["arch"]
         if self._arch not in QEMU_ARCH:
             raise RuntimeError(f"unsupported architecture: {self._arch}")
@@ -58,10 +94,30 @@ class VM:
         self._path_root = self._path / "root.qcow2"
 
         self._process = None
+        self._cancelled = False
+        # Guards against a shutdown being requested (from another thread or a signal handler)
+        # while the VM is being started. Reentrant, as signal handlers run on the main thread.
+        self._start_lock = threading.RLock()
         self._qmp_shutdown_path = self._path / "shutdown.sock"
 
         self._copy_base_image()
 
+        # Start the credential server as part of preparing the VM, so that in loop mode the
+        # jitconfig is ready to be served before the VM is even started.
+        self._jitconfig = CredentialServer("gha-jitconfig-url", self._runner.jitconfig)
+
+    @property
+    def runner_id(self):
+        return self._runner.id
+
+    @property
+    def runner_registered_at(self):
+        return self._runner.registered_at
+
+    @property
+    def job_started(self):
+        return self._prevent_external_shutdowns
+
     def _copy_base_image(self):
         if self._path.exists():
             shutil.rmtree(self._path)
@@ -96,6 +152,42 @@ class VM:
         if self._process is not None:
             raise RuntimeError("this VM was already started")
 
+        label = self._instance["label"]
+        for attempt in range(1, MAX_BOOT_ATTEMPTS + 1):
+            self._run_once(gh)
+            if self.boot_failure is None or self._shutdown_requested:
+                return
+            if attempt == MAX_BOOT_ATTEMPTS:
+                break
+
+            log(f"retrying with a fresh VM (attempt {attempt + 1}/{MAX_BOOT_ATTEMPTS})")
+            metrics.increment(
+                "gha_executor_boot_retries_total", label=label, stage=self.boot_failure
+            )
+            self._reset(gh)
+
+        log(f"giving up after the VM failed to boot {MAX_BOOT_ATTEMPTS} times")
+        metrics.increment(
+            "gha_executor_boot_give_ups_total", label=label, stage=self.boot_failure
+        )
+
+    # Prepare a fresh overlay and a new runner after a failed boot. The old runner is deregistered,
+    # as it would otherwise linger in the organization as offline.
+    def _reset(self, gh):
+        gh.delete_runner(self._runner.id)
+        self._jitconfig.close()
+
+        self._copy_base_image()
+        self._runner = gh.create_runner(self._cli, self._instance)
+        self._jitconfig = CredentialServer("gha-jitconfig-url", self._runner.jitconfig)
+
+        self._process = None
+        self._timers = []
+        self._runner_online = False
+        self._runner_last_report = None
+        self.boot_failure = None
+
+    def _run_once(self, gh):
         qemu = QemuInvocation(
             cpu_cores=self._cpu,
             memory=self._ram,
@@ -120,11 +212,14 @@ class VM:
         if self._cli.no_shutdown_after_job:
             qemu.smbios_11.append("value=io.systemd.credential:gha-inhibit-shutdown=1")
 
-        jitconfig = CredentialServer("gha-jitconfig-url", self._runner.jitconfig)
-        jitconfig.configure_qemu(qemu)
+        self._jitconfig.configure_qemu(qemu)
 
-        log("starting the virtual machine")
-        self._process = qemu.spawn()
+        with self._start_lock:
+            if self._cancelled:
+                log("not starting the VM, as a shutdown was requested")
+                return
+            log("starting the virtual machine")
+            self._process = qemu.spawn()
 
         if self._cli.ssh_port is not None:
             print()
@@ -137,11 +232,21 @@ class VM:
             )
             print()
 
-        GitHubRunnerStatusWatcher(gh, self._runner.id, self._gha_build_started).start()
+        self._status_watcher = GitHubRunnerStatusWatcher(
+            gh, self._runner.id, self._gha_build_started, self._gha_runner_status
+        )
+        self._status_watcher.start()
+
+        # When the VM is asked not to shutdown after the job it's being debugged, and killing it
+        # because the runner didn't come online would get in the way.
+        if not self._cli.no_shutdown_after_job:
+            self._boot_watchdog = BootWatchdog(self)
+            self._boot_watchdog.start()
 
         try:
             self._process.wait()
         except KeyboardInterrupt:
+            self.interrupted = True
             self._shutdown()
 
         # Shutdown signal was successful, wait for clean shutdown
@@ -151,16 +256,66 @@ class VM:
         except KeyboardInterrupt:
             self._kill()
 
+        self._status_watcher.stop()
+        if self._boot_watchdog is not None:
+            self._boot_watchdog.stop()
+        for timer in self._timers:
+            timer.cancel()
+
+        # A VM powering off on its own before fetching its credential also failed to boot. Later
+        # stages are not checked here, as a short job could finish before the runner status is
+        # polled again, and the VM would wrongly look like it never came online.
+        if self.boot_failure is None and not self._shutdown_requested:
+            for stage in ("qemu-started", "credential-fetched"):
+                if not self.boot_stage_reached(stage):
+                    log(f"the VM exited before reaching the {stage} stage")
+                    self.boot_failure = stage
+                    break
+
+    def boot_stage_reached(self, stage):
+        if stage == "qemu-started":
+            return self._qmp_shutdown_path.exists()
+        elif stage == "credential-fetched":
+            return self._jitconfig.retrieved.is_set()
+        elif stage == "runner-online":
+            return self._runner_online or self._prevent_external_shutdowns
+        raise RuntimeError(f"unknown boot stage: {stage}")
+
+    # Whether there is evidence the VM failed to reach a stage once its deadline passed. The runner
+    # status comes from the GitHub API, so a VM is only considered failed when GitHub recently
+    # reported its runner as offline: otherwise an API outage (or the status watcher crashing)
+    # would kill VMs that booted correctly, and that might even be running a job already.
+    def boot_stage_failed(self, stage):
+        if stage != "runner-online":
+            return True
+        if self._runner_last_report is None:
+            return False
+        reported_at, online = self._runner_last_report
+        return not online and time.time() - reported_at < 2 * GITHUB_API_POLL_INTERVAL
+
+    def boot_deadline_missed(self, stage):
+        self.boot_failure = stage
+        log(f"the VM did not reach the {stage} stage in time, killing it")
+        with self._start_lock:
+            if self._process is not None:
+                self._kill()
+
     def request_shutdown(self, reason):
         if self._prevent_external_shutdowns:
             log(f"did not shutdown due to {reason} because a build is running")
         else:
+            with self._start_lock:
+                if self._process is None:
+                    log(f"VM will not start due to {reason}")
+                    self._cancelled = True
+                    return
             log(f"shutting down the VM due to {reason}")
             self._shutdown()
 
     def _shutdown(self):
         if self._process is None:
             raise RuntimeError("can't shutdown a stopped VM")
+        self._shutdown_requested = True
 
         # QEMU allows interacting with the VM through the "monitoring port",
         # using Telnet as the protocol. This tries to connect to the monitoring
@@ -176,9 +331,9 @@ class VM:
 
         log("sent shutdown signal to the VM")
 
-        Timer(
-            "graceful-shutdown-timeout", self._kill, GRACEFUL_SHUTDOWN_TIMEOUT
-        ).start()
+        self._start_timer(
+            Timer("graceful-shutdown-timeout", self._kill, GRACEFUL_SHUTDOWN_TIMEOUT)
+        )
 
     def _kill(self):
         if self._process is None:
@@ -190,11 +345,79 @@ class VM:
         log("killed the virtual machine")
 
     def cleanup(self):
+        # The VM might still be running when the executor is cleaning up after an error.
+        with self._start_lock:
+            if self._process is not None and self._process.poll() is None:
+                self._kill()
+        self._jitconfig.close()
         shutil.rmtree(str(self._path))
 
+    def _gha_runner_status(self, runner):
+        online = runner["status"] == "online"
+        self._runner_last_report = (time.time(), online)
+        if online:
+            self._runner_online = True
+
     def _gha_build_started(self):
         self._prevent_external_shutdowns = True
-        Timer("vm-timeout", self._shutdown, self._vm_timeout).start()
+        self._start_timer(Timer("vm-timeout", self._shutdown, self._vm_timeout))
+
+    def _start_timer(self, timer):
+        self._timers.append(timer)
+        timer.start()
+
+
+# Register a runner and prepare a VM for it, without starting the VM yet.
+def prepare_vm(cli, instance, images, gh) -> VM:
+    image = images.get_image(instance["image"])
+    runner = gh.create_runner(cli, instance)
+    try:
+        return VM(cli, instance, image, runner)
+    except BaseException:
+        gh.delete_runner(runner.id)
+        raise
+
+
+# Run a prepared VM until it powers off, and then clean it up. The cleanup also happens when running
+# the VM fails, so that neither its disk nor its runner are leaked.
+def run_and_cleanup_vm(vm: VM, gh):
+    try:
+        vm.run(gh)
+    finally:
+        vm.cleanup()
+
+        # Runners that never picked up a job are not removed automatically by GitHub.
+        if not vm.job_started:
+            gh.delete_runner(vm.runner_id)
+
+
+class BootWatchdog(threading.Thread):
+    def __init__(self, vm: VM):
+        super().__init__(name="boot-watchdog", daemon=True)
+
+        self._vm = vm
+        self._stopped = threading.Event()
+
+    def run(self):
+        started_at = time.time()
+        for stage, deadline in BOOT_DEADLINES:
+            warned = False
+            while not self._vm.boot_stage_reached(stage):
+                if time.time() > started_at + deadline:
+                    if self._vm.boot_stage_failed(stage):
+                        self._vm.boot_deadline_missed(stage)
+                        return
+                    if not warned:
+                        log(
+                            f"deadline for {stage} passed, but GitHub didn't report the runner"
+                        )
+                        warned = True
+                if self._stopped.wait(1):
+                    return
+            log(f"the VM reached the {stage} stage")
+
+    def stop(self):
+        self._stopped.set()
 
 
 @dataclass
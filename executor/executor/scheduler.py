@@ -0,0 +1,312 @@
+# Demand-driven autoscaling of VMs.
+#
+# Rather than registering a single runner and waiting for a job to be assigned to it, in autoscale
+# mode the executor periodically checks how many jobs are queued for each label, and starts or
+# retires VMs accordingly, within the CPU, RAM and disk capacity of the host.
+#
+# The scaling decisions are made by `LabelScaler`, which doesn't depend on GitHub or QEMU: this
+# allows the same policy to be replayed against recorded queue traces (see `simulation.py`), to
+# compare policies based on the time jobs spend in the queue and on the cost of idle runners.
+
+from .github import GitHub, GitHubError
+from .images import ImagesRetriever
+from .qemu import VM, prepare_vm, run_and_cleanup_vm
+from .utils import log, parse_size
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+import os
+import requests
+import shutil
+import tempfile
+import threading
+import time
+
+
+# How many seconds should pass between each check of the finished VMs.
+SCHEDULER_INTERVAL = 15
+
+# How many seconds should pass between each scaling decision, unless overridden. Each decision
+# checks the queued jobs, which requires a request for each run of each repository.
+DEFAULT_QUEUE_POLL_INTERVAL = 60
+
+# How many seconds an idle VM surplus must last before VMs are retired, unless the instance
+# specification overrides it.
+DEFAULT_SCALE_DOWN_DELAY = 5 * 60
+
+
+@dataclass
+class Resources:
+    cpu_cores: int
+    ram: int
+    disk: int
+
+    @staticmethod
+    def of_instance(instance):
+        return Resources(
+            cpu_cores=instance["cpu-cores"],
+            # QEMU interprets RAM sizes without a suffix as megabytes.
+            ram=parse_size(instance["ram"], default_unit=1024**2),
+            disk=parse_size(instance["root-disk"]),
+        )
+
+    @staticmethod
+    def of_host(cli):
+        cpu_cores = cli.host_cpu_cores
+        if cpu_cores is None:
+            cpu_cores = os.cpu_count()
+
+        ram = cli.host_ram
+        if ram is None:
+            ram = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        else:
+            ram = parse_size(ram, default_unit=1024**2)
+
+        disk = cli.host_disk
+        if disk is None:
+            # The VM disks are created in the temporary directory, so that's where space is needed.
+            disk = shutil.disk_usage(tempfile.gettempdir()).free
+        else:
+            disk = parse_size(disk)
+
+        return Resources(cpu_cores=cpu_cores, ram=ram, disk=disk)
+
+    def fits(self, other):
+        return (
+            other.cpu_cores <= self.cpu_cores
+            and other.ram <= self.ram
+            and other.disk <= self.disk
+        )
+
+    def __add__(self, other):
+        return Resources(
+            cpu_cores=self.cpu_cores + other.cpu_cores,
+            ram=self.ram + other.ram,
+            disk=self.disk + other.disk,
+        )
+
+
+def add_host_capacity_arguments(parser):
+    parser.add_argument(
+        "--host-cpu-cores",
+        help="CPU cores that can be allocated to VMs when autoscaling (default: all of them)",
+        type=int,
+    )
+    parser.add_argument(
+        "--host-ram",
+        help="RAM that can be allocated to VMs when autoscaling (default: all of it)",
+    )
+    parser.add_argument(
+        "--host-disk",
+        help="Disk space that can be allocated to VMs when autoscaling (default: the free space)",
+    )
+
+
+@dataclass
+class ScalingPolicy:
+    # Idle VMs to keep around on top of the queued jobs, to absorb new jobs without cold boots.
+    min_warm: int = 0
+    # Maximum number of VMs (idle or busy) for the instance, regardless of the host capacity.
+    max_instances: Optional[int] = None
+    # How many seconds an idle VM surplus must last before VMs are retired.
+    scale_down_delay: float = DEFAULT_SCALE_DOWN_DELAY
+
+    @staticmethod
+    def of_instance(instance):
+        return ScalingPolicy(
+            min_warm=instance.get("min-warm", 0),
+            max_instances=instance.get("max-instances"),
+            scale_down_delay=instance.get(
+                "scale-down-delay-seconds", DEFAULT_SCALE_DOWN_DELAY
+            ),
+        )
+
+
+class LabelScaler:
+    def __init__(self, policy: ScalingPolicy):
+        self.policy = policy
+        self._surplus_since: Optional[float] = None
+
+    # Return how many VMs should be started (when positive) or retired (when negative).
+    #
+    # VMs are started as soon as there are more queued jobs than idle VMs, as every second spent
+    # waiting is a second a job sits in the queue. Retiring VMs is instead subject to hysteresis:
+    # the surplus has to last for the whole scale down delay, to avoid shutting down VMs that would
+    # have to be booted again shortly after when the queue fluctuates.
+    def decide(self, now, queued, idle, busy):
+        delta = queued + self.policy.min_warm - idle
+
+        if delta > 0:
+            self._surplus_since = None
+            if self.policy.max_instances is not None:
+                delta = min(delta, self.policy.max_instances - idle - busy)
+            return max(delta, 0)
+        elif delta == 0:
+            self._surplus_since = None
+            return 0
+
+        if self._surplus_since is None:
+            self._surplus_since = now
+        if now - self._surplus_since < self.policy.scale_down_delay:
+            return 0
+
+        self._surplus_since = None
+        return delta
+
+
+class GitHubJobsQueue:
+    def __init__(self, gh: GitHub, repos: List[str]):
+        self._gh = gh
+        self._repos = repos
+
+    def queued_jobs(self) -> Dict[str, int]:
+        queued: Counter = Counter()
+        for repo in self._repos:
+            for job in self._gh.get_queued_jobs(repo):
+                for label in job["labels"]:
+                    queued[label] += 1
+        return queued
+
+
+# A single VM managed by the scheduler, prepared and run in its own thread.
+class VMSlot(threading.Thread):
+    def __init__(self, cli, instance, images: ImagesRetriever, gh: GitHub):
+        super().__init__(name=f"vm-slot-{instance['label']}", daemon=True)
+
+        self.instance = instance
+        self.resources = Resources.of_instance(instance)
+        self.retired = False
+        self._retire_reason = None
+
+        self._cli = cli
+        self._images = images
+        self._gh = gh
+        self._vm: Optional[VM] = None
+
+    @property
+    def busy(self):
+        return self._vm is not None and self._vm.job_started
+
+    def run(self):
+        self._vm = prepare_vm(self._cli, self.instance, self._images, self._gh)
+
+        # The slot might have been retired while the VM was being prepared: the VM is then cleaned
+        # up without being started.
+        if self.retired:
+            self._vm.request_shutdown(self._retire_reason)
+        run_and_cleanup_vm(self._vm, self._gh)
+
+    def retire(self, reason):
+        self.retired = True
+        self._retire_reason = reason
+        if self._vm is not None:
+            self._vm.request_shutdown(reason)
+
+
+class Scheduler:
+    def __init__(self, cli, instances, images: ImagesRetriever, gh: GitHub, queue):
+        self._cli = cli
+        self._instances = instances
+        self._images = images
+        self._gh = gh
+        self._queue = queue
+        self._capacity = Resources.of_host(cli)
+
+        self._scalers = {
+            instance["label"]: LabelScaler(ScalingPolicy.of_instance(instance))
+            for instance in instances
+        }
+        self._slots: List[VMSlot] = []
+
+        self._stopping = False
+        self._image_update_pending = False
+
+    def run(self):
+        log(
+            f"autoscaling {len(self._instances)} instance specs within {self._capacity.cpu_cores} "
+            f"cores, {self._capacity.ram // 1024**2}M of RAM and {self._capacity.disk // 1024**3}G "
+            "of disk"
+        )
+        next_tick = 0.0
+        while True:
+            self._slots = [slot for slot in self._slots if slot.is_alive()]
+            if self._stopping:
+                if not self._slots:
+                    break
+            elif time.time() >= next_tick:
+                next_tick = time.time() + self._cli.autoscale_poll_interval
+                self.tick(time.time())
+            time.sleep(SCHEDULER_INTERVAL)
+
+    def stop(self, reason):
+        self._stopping = True
+        self._retire_idle(reason)
+
+    def new_image(self):
+        self._image_update_pending = True
+        self._retire_idle("new image available")
+
+    def tick(self, now):
+        if self._image_update_pending:
+            # Wait for all the VMs using the old image to either be retired or running a job before
+            # switching images. Busy VMs are not affected by the old images being purged from the
+            # cache, as QEMU keeps their backing file open.
+            if any(not slot.busy for slot in self._slots):
+                return
+            self._images.update()
+            self._image_update_pending = False
+
+            # Download and verify the new images here rather than in the VM slots, as the slots
+            # started in the same tick would otherwise download the same image concurrently.
+            for instance in self._instances:
+                self._images.get_image(instance["image"])
+
+        # A GitHub outage must not stop the scheduler, as nothing would then enforce the timeout of
+        # the VMs that are running, or deregister the runners of the retired ones.
+        try:
+            queued = self._queue.queued_jobs()
+        except (requests.RequestException, GitHubError) as e:
+            log(
+                f"error: failed to retrieve the queued jobs, skipping scaling decisions: {e}"
+            )
+            return
+        used = Resources(cpu_cores=0, ram=0, disk=0)
+        for slot in self._slots:
+            used += slot.resources
+
+        # Serve the labels with the most queued jobs first when the host is at capacity.
+        for instance in sorted(
+            self._instances, key=lambda i: queued.get(i["label"], 0), reverse=True
+        ):
+            label = instance["label"]
+            slots = [s for s in self._slots if s.instance is instance]
+            busy = [s for s in slots if s.busy]
+            idle = [s for s in slots if not s.busy and not s.retired]
+
+            delta = self._scalers[label].decide(
+                now, queued.get(label, 0), len(idle), len(busy)
+            )
+            if delta > 0:
+                needed = Resources.of_instance(instance)
+                for _ in range(delta):
+                    if not self._capacity.fits(used + needed):
+                        log(f"not enough host capacity to start a VM for {label}")
+                        break
+                    log(
+                        f"starting a VM for {label} ({queued.get(label, 0)} jobs queued)"
+                    )
+                    slot = VMSlot(self._cli, instance, self._images, self._gh)
+                    slot.start()
+                    self._slots.append(slot)
+                    used += needed
+            elif delta < 0:
+                # Retire the most recently started VMs, as they are the ones most likely to still
+                # be booting.
+                log(f"retiring {-delta} idle VMs for {label}")
+                for slot in idle[delta:]:
+                    slot.retire("scaling down")
+
+    def _retire_idle(self, reason):
+        for slot in self._slots:
+            if not slot.busy:
+                slot.retire(reason)
@@ -0,0 +1,140 @@
+# Replay recorded queue traces against the autoscaling policies.
+#
+# Experimenting with scaling policies on the production fleet is slow and expensive, so this module
+# simulates a host running the same `LabelScaler` used by the real scheduler, fed by a trace of
+# jobs rather than by the GitHub API. The trace is a JSON list of jobs, each one with the `label`
+# it requested, the `queued-at` timestamp (in seconds) and its `duration` (in seconds), which can
+# be derived from the `created_at`, `started_at` and `completed_at` fields of the GitHub API.
+#
+# The simulation reports how long jobs waited in the queue, and how many VM-seconds were spent on
+# idle (or booting) VMs, which is the cost paid to reduce the queue wait.
+
+from .scheduler import (
+    DEFAULT_QUEUE_POLL_INTERVAL,
+    LabelScaler,
+    Resources,
+    ScalingPolicy,
+)
+from .utils import log
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional
+
+
+@dataclass
+class SimulatedVM:
+    instance: dict
+    resources: Resources
+    ready_at: float
+    busy_until: Optional[float] = None
+
+
+@dataclass
+class LabelStats:
+    waits: List[float] = field(default_factory=list)
+    # Jobs that could never run, as no VM for their label fits the host or the policy.
+    unserved: int = 0
+    boots: int = 0
+    busy_seconds: float = 0
+    idle_seconds: float = 0
+
+    def percentile(self, pct):
+        if not self.waits:
+            return 0
+        waits = sorted(self.waits)
+        return waits[min(len(waits) - 1, int(len(waits) * pct / 100))]
+
+
+def simulate(
+    jobs,
+    instances,
+    policies: Dict[str, ScalingPolicy],
+    capacity: Resources,
+    boot_seconds,
+    interval=DEFAULT_QUEUE_POLL_INTERVAL,
+):
+    jobs = sorted(jobs, key=lambda job: job["queued-at"])
+    scalers = {label: LabelScaler(policy) for label, policy in policies.items()}
+    stats = {instance["label"]: LabelStats() for instance in instances}
+
+    # Jobs for labels that can never get a VM would stay queued forever, preventing the
+    # simulation from ending, so they are only counted rather than queued.
+    servable = set()
+    for instance in instances:
+        max_instances = policies[instance["label"]].max_instances
+        if not capacity.fits(Resources.of_instance(instance)):
+            log(
+                f"warning: instance {instance['label']} doesn't fit in the host capacity"
+            )
+        elif max_instances is not None and max_instances <= 0:
+            log(f"warning: instance {instance['label']} has no instances allowed")
+        else:
+            servable.add(instance["label"])
+
+    queues: Dict[str, Deque[dict]] = {label: deque() for label in stats}
+    vms: List[SimulatedVM] = []
+    next_job = 0
+
+    now = jobs[0]["queued-at"] if jobs else 0
+    next_decision = now
+    while (
+        next_job < len(jobs)
+        or any(queues.values())
+        or any(vm.busy_until is not None for vm in vms)
+    ):
+        vms = [vm for vm in vms if vm.busy_until is None or vm.busy_until > now]
+
+        while next_job < len(jobs) and jobs[next_job]["queued-at"] <= now:
+            job = jobs[next_job]
+            if job["label"] in servable:
+                queues[job["label"]].append(job)
+            elif job["label"] in stats:
+                stats[job["label"]].unserved += 1
+            next_job += 1
+
+        # Like GitHub, assign queued jobs to the runners that are online and idle.
+        for vm in vms:
+            queue = queues[vm.instance["label"]]
+            if vm.busy_until is None and vm.ready_at <= now and queue:
+                job = queue.popleft()
+                stats[vm.instance["label"]].waits.append(now - job["queued-at"])
+                vm.busy_until = now + job["duration"]
+
+        if now >= next_decision:
+            _decide(now, instances, scalers, stats, queues, vms, capacity, boot_seconds)
+            next_decision = now + interval
+
+        for vm in vms:
+            if vm.busy_until is None:
+                stats[vm.instance["label"]].idle_seconds += 1
+            else:
+                stats[vm.instance["label"]].busy_seconds += 1
+        now += 1
+
+    return stats
+
+
+def _decide(now, instances, scalers, stats, queues, vms, capacity, boot_seconds):
+    used = Resources(cpu_cores=0, ram=0, disk=0)
+    for vm in vms:
+        used += vm.resources
+
+    for instance in sorted(
+        instances, key=lambda i: len(queues[i["label"]]), reverse=True
+    ):
+        label = instance["label"]
+        idle = [v for v in vms if v.instance is instance and v.busy_until is None]
+        busy = [v for v in vms if v.instance is instance and v.busy_until is not None]
+
+        delta = scalers[label].decide(now, len(queues[label]), len(idle), len(busy))
+        if delta > 0:
+            needed = Resources.of_instance(instance)
+            for _ in range(delta):
+                if not capacity.fits(used + needed):
+                    break
+                vms.append(SimulatedVM(instance, needed, ready_at=now + boot_seconds))
+                stats[label].boots += 1
+                used += needed
+        elif delta < 0:
+            for vm in idle[delta:]:
+                vms.remove(vm)
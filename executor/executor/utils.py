@@ -1,6 +1,9 @@
 import sys
 import threading
-import time
+
+
+# Suffixes accepted by QEMU for sizes (like "4G").
+SIZE_SUFFIXES = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
 
 
 def log(*args, **kwargs):
@@ -8,6 +11,16 @@ def log(*args, **kwargs):
     sys.stdout.flush()
 
 
+# Convert a size in the format accepted by QEMU into bytes. Sizes without a suffix are multiplied
+# by the default unit, as QEMU interprets them differently depending on the flag.
+def parse_size(size, default_unit=1):
+    size = str(size).strip()
+    suffix = size[-1:].upper()
+    if suffix in SIZE_SUFFIXES:
+        return int(size[:-1]) * SIZE_SUFFIXES[suffix]
+    return int(size) * default_unit
+
+
 # Simple thread that executes a function after a timeout
 class Timer(threading.Thread):
     def __init__(self, name, callback, timeout):
@@ -16,14 +29,18 @@ class Timer(threading.Thread):
         self._name = name
         self._callback = callback
         self._timeout = timeout
+        self._cancelled = threading.Event()
 
     def run(self):
         log(f"started timer {self._name}, fires in {self._timeout} seconds")
 
-        # The sleep is done in a loop to handle spurious wakeups
-        started_at = time.time()
-        while time.time() < started_at + self._timeout:
-            time.sleep(self._timeout - (time.time() - started_at))
+        # Event.wait() already handles spurious wakeups, and returns early if the timer is
+        # cancelled before the timeout expires.
+        if self._cancelled.wait(self._timeout):
+            return
 
         log(f"timer {self._name} fired")
         self._callback()
+
+    def cancel(self):
+        self._cancelled.set()
@@ -1,51 +1,176 @@
 #!/usr/bin/env -S uv run
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List
 from executor.github import GitHub
 from executor.images import ImageUpdateWatcher, ImagesRetriever
-from executor.qemu import VM
+from executor.qemu import VM, prepare_vm, run_and_cleanup_vm
+from executor import metrics
+from executor.scheduler import (
+    DEFAULT_QUEUE_POLL_INTERVAL,
+    GitHubJobsQueue,
+    Scheduler,
+    add_host_capacity_arguments,
+)
+from executor.utils import log
 import argparse
 import json
 import signal
+import tempfile
+import time
 
 
 running_vms: List[VM] = []
 
+# How many seconds a runner prepared in loop mode can wait before being used. GitHub removes runners
+# that never connected after about a day, so this keeps a wide margin.
+PREPARED_RUNNER_MAX_AGE = 12 * 60 * 60
+
+# Flags checked by the loop mode between jobs.
+stop_requested = False
+image_update_pending = False
+
 
 def sigterm_received(_sig, _frame):
+    global stop_requested
+    stop_requested = True
     for vm in running_vms:
         vm.request_shutdown("SIGTERM signal")
 
 
 def new_image():
+    global image_update_pending
+    image_update_pending = True
     for vm in running_vms:
         vm.request_shutdown("new image available")
 
 
 def run(cli):
     signal.signal(signal.SIGTERM, sigterm_received)
+    metrics.configure(cli.metrics_file)
 
-    with open(cli.instance_spec) as f:
-        instance = json.load(f)
+    instances = []
+    for path in cli.instance_spec:
+        with open(path) as f:
+            instances.append(json.load(f))
 
     images = ImagesRetriever(cli)
-    image = images.get_image(instance["image"])
-    ImageUpdateWatcher(images, new_image).start()
+    for instance in instances:
+        images.get_image(instance["image"])
 
     gh = GitHub(cli)
-    runner = gh.create_runner(cli, instance)
 
-    vm = VM(cli, instance, image, runner)
+    if cli.autoscale:
+        run_autoscale(cli, instances, images, gh)
+        return
+
+    instance = instances[0]
+    ImageUpdateWatcher(images, new_image).start()
+
+    if cli.loop:
+        run_loop(cli, instance, images, gh)
+    else:
+        vm = prepare_vm(cli, instance, images, gh)
+        run_vm(vm, gh)
+        if vm.boot_failure is not None:
+            exit(1)
+
+
+def run_loop(cli, instance, images, gh):
+    global image_update_pending
+
+    # The next VM (its disk overlay, runner registration and credential server) is prepared in
+    # the background while the current one is running, so that it can be started as soon as the
+    # current VM powers off.
+    preparer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vm-preparer")
+    next_vm = preparer.submit(prepare_vm, cli, instance, images, gh)
+    vm = None
+
+    # Prepared VMs are discarded (deregistering their runner) however the loop exits, including
+    # when a Ctrl+C or an exception interrupts it while a VM is being prepared.
+    try:
+        while True:
+            vm = next_vm.result()
+            next_vm = None
+            if stop_requested:
+                break
+
+            # GitHub removes runners that never connected after a while, and the VM would then
+            # boot with a jitconfig that doesn't work anymore. This can happen when the previous
+            # VM waited for a job or ran one for a long time.
+            if time.time() - vm.runner_registered_at > PREPARED_RUNNER_MAX_AGE:
+                log("the prepared runner is too old, registering a new one")
+                discard_vm(vm, gh)
+                vm = None
+                vm = prepare_vm(cli, instance, images, gh)
+
+            next_vm = preparer.submit(prepare_vm, cli, instance, images, gh)
+            current, vm = vm, None
+            run_vm(current, gh)
+
+            if stop_requested or current.interrupted:
+                break
+            # Exit like in single mode, so that the init system restarts the executor after a delay
+            # rather than runners being registered over and over on a broken host.
+            if current.boot_failure is not None:
+                exit(1)
+
+            # The prepared VM uses the old image, so it has to be thrown away before switching to
+            # the new images (which also purges the old ones from the cache).
+            if image_update_pending:
+                image_update_pending = False
+                prepared, next_vm = next_vm.result(), None
+                discard_vm(prepared, gh)
+                images.update()
+                next_vm = preparer.submit(prepare_vm, cli, instance, images, gh)
+    finally:
+        if vm is not None:
+            discard_vm(vm, gh)
+        if next_vm is not None and next_vm.exception() is None:
+            discard_vm(next_vm.result(), gh)
+        preparer.shutdown()
+
+
+def run_autoscale(cli, instances, images, gh):
+    queue = GitHubJobsQueue(gh, cli.autoscale_repo)
+    scheduler = Scheduler(cli, instances, images, gh, queue)
+
+    signal.signal(signal.SIGTERM, lambda _sig, _frame: scheduler.stop("SIGTERM signal"))
+    ImageUpdateWatcher(images, scheduler.new_image).start()
+
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        # Stop starting new VMs, and wait for the jobs currently running to finish.
+        scheduler.stop("Ctrl+C")
+        scheduler.run()
+
+
+def run_vm(vm, gh):
     running_vms.append(vm)
+    try:
+        run_and_cleanup_vm(vm, gh)
+    finally:
+        running_vms.remove(vm)
+
 
-    vm.run(gh)
+def discard_vm(vm, gh):
+    log(f"discarding prepared VM for runner {vm.runner_id}")
+    gh.delete_runner(vm.runner_id)
     vm.cleanup()
 
 
+def positive_int(value):
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive number")
+    return number
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("instance_spec")
+    parser.add_argument("instance_spec", nargs="+")
 
     parser.add_argument(
         "--github-client-id",
@@ -70,6 +195,18 @@ def main():
         required=True,
     )
 
+    parser.add_argument(
+        "--github-api-budget",
+        help="GitHub API requests per hour shared by all the executors on this host",
+        type=positive_int,
+    )
+    parser.add_argument(
+        "--github-api-budget-file",
+        help="File used to share the GitHub API budget between the executors on this host",
+        type=Path,
+        default=Path(tempfile.gettempdir()) / "gha-self-hosted-github-api-budget.json",
+    )
+
     parser.add_argument(
         "--images-server",
         help="HTTP server to retrieve images from",
@@ -87,6 +224,37 @@ def main():
         action="store_true",
     )
 
+    parser.add_argument(
+        "--loop",
+        help="Keep running jobs back to back instead of exiting after the first one",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--autoscale",
+        help="Start and retire VMs based on the jobs queued in GitHub Actions",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--autoscale-repo",
+        help="Repository in the GitHub org to watch for queued jobs (can be repeated)",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--autoscale-poll-interval",
+        help="Seconds between each check of the jobs queued in GitHub Actions",
+        type=positive_int,
+        default=DEFAULT_QUEUE_POLL_INTERVAL,
+    )
+    add_host_capacity_arguments(parser)
+
+    parser.add_argument(
+        "--metrics-file",
+        help="File to write metrics to, in the Prometheus text format",
+        type=Path,
+    )
+
     parser.add_argument(
         "--ssh-port",
         help="Port to bind the SSH server to",
@@ -94,6 +262,13 @@ def main():
     )
 
     args = parser.parse_args()
+    if len(args.instance_spec) > 1 and not args.autoscale:
+        parser.error("multiple instance specs can only be passed with --autoscale")
+    if args.autoscale and not args.autoscale_repo:
+        parser.error("--autoscale requires at least one --autoscale-repo")
+    if args.autoscale and (args.loop or args.ssh_port is not None):
+        parser.error("--autoscale can't be used with --loop or --ssh-port")
+
     run(args)
 
 
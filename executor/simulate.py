@@ -0,0 +1,74 @@
+#!/usr/bin/env -S uv run
+
+from executor.scheduler import Resources, ScalingPolicy, add_host_capacity_arguments
+from executor.simulation import simulate
+import argparse
+import json
+
+
+def run(cli):
+    with open(cli.trace) as f:
+        jobs = json.load(f)
+
+    instances = []
+    for path in cli.instance_spec:
+        with open(path) as f:
+            instances.append(json.load(f))
+
+    policies = {}
+    for instance in instances:
+        policy = ScalingPolicy.of_instance(instance)
+        if cli.min_warm is not None:
+            policy.min_warm = cli.min_warm
+        if cli.scale_down_delay is not None:
+            policy.scale_down_delay = cli.scale_down_delay
+        policies[instance["label"]] = policy
+
+    stats = simulate(
+        jobs, instances, policies, Resources.of_host(cli), cli.boot_seconds
+    )
+
+    print(
+        f"{'label':<24} {'jobs':>6} {'mean wait':>10} {'p95 wait':>10} {'max wait':>10} "
+        f"{'unserved':>9} {'boots':>6} {'busy hours':>11} {'idle hours':>11}"
+    )
+    for label, s in stats.items():
+        mean = sum(s.waits) / len(s.waits) if s.waits else 0
+        print(
+            f"{label:<24} {len(s.waits):>6} {mean:>9.0f}s {s.percentile(95):>9.0f}s "
+            f"{max(s.waits, default=0):>9.0f}s {s.unserved:>9} {s.boots:>6} "
+            f"{s.busy_seconds / 3600:>11.1f} {s.idle_seconds / 3600:>11.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a queue trace against the autoscaling policies"
+    )
+    parser.add_argument("trace")
+    parser.add_argument("instance_spec", nargs="+")
+
+    parser.add_argument(
+        "--boot-seconds",
+        help="How many seconds it takes for a VM to boot and for its runner to go online",
+        type=int,
+        default=60,
+    )
+    parser.add_argument(
+        "--min-warm",
+        help="Override the minimum number of warm VMs of all instance specs",
+        type=int,
+    )
+    parser.add_argument(
+        "--scale-down-delay",
+        help="Override the scale down delay (in seconds) of all instance specs",
+        type=int,
+    )
+    add_host_capacity_arguments(parser)
+
+    args = parser.parse_args()
+    run(args)
+
+
+if __name__ == "__main__":
+    main()